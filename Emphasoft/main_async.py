@@ -1,100 +1,235 @@
 import asyncio
-import aiofiles
-from aiohttp import ClientSession as aiohttp_ClientSession
-from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count as os_cpu_count, replace as os_replace
+from os.path import getsize as os_path_getsize, exists as os_path_exists
+from httpx import (AsyncClient as httpx_AsyncClient,
+                   Limits as httpx_Limits,
+                   Timeout as httpx_Timeout,
+                   TransportError as httpx_TransportError,
+                   URL as httpx_URL, )
+from lxml.html import fromstring as lxml_html_fromstring
 from pathlib import Path as pathlib_Path
-from json import dumps as json_dumps
+from orjson import dumps as orjson_dumps
 from loguru import logger
 from sys import platform as sys_platform
 
 # # # HARDCODED # # #
 MIN_YEAR = 2018
 MAX_YEAR = 2020
-
-
-def is_key_in_dict(dict_key: str, array: list):
-    for i, dict_ in enumerate(array):
-        if dict_['form_number'] == dict_key:
-            return i
-
-
-async def load_page(url: str, session, ):
-    async with session.get(url=url, ) as resp:
-        if 200 <= resp.status <= 299:
-            return await resp.read()
+PAGE_SIZE = 200  # resultsPerPage
+PAGES_IN_FLIGHT = 16  # Pages fetched speculatively at once
+MAX_REQUESTS = 32  # Concurrent requests at once
+MAX_RETRIES = 5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+WRITE_BUFFER_SIZE = 1 << 20  # 1 MiB
+PAGE_BASE_URL = 'https://apps.irs.gov/app/picklist/list/priorFormPublication.html'
+PAGE_PARAMS = {'sortColumn': 'sortOrder', 'value': '', 'criteria': '', 'resultsPerPage': PAGE_SIZE,
+               'isDescending': 'false', }  # Blank value and criteria are sent as well
+FORMS_JSON_DIR = 'forms_json'  # One json file per page
+ROW_CELLS_CLASSES = ('LeftCellSpacer', 'MiddleCellSpacer', 'EndCellSpacer')  # Product number, title, revision date
+
+_created_dirs: set[str] = set()  # Forms dirs already created by this process
+_downloaded: set[tuple[str, int]] = set()  # form_number, current_year of the scheduled pdf
+
+
+async def load_page(url: str, client: httpx_AsyncClient, semaphore: asyncio.Semaphore, ):
+    for attempt in range(MAX_RETRIES):
+        try:
+            async with semaphore:
+                resp = await client.get(url=url, )
+        except httpx_TransportError as e:  # Timeouts and connection errors are retried as well
+            error = f'error: {e!r}'
         else:
-            logger.error(f'Can not access a page, returned status code: {resp.status_code}')
-
-
-async def parse_page_forms_json(rows: list) -> list[str]:  # Every page contain set of forms
-    page_forms = []
-    for row in rows:
+            if 200 <= resp.status_code <= 299:
+                return resp.content
+            error = f'returned status code: {resp.status_code}'
+            if resp.status_code not in RETRY_STATUSES:
+                break
+        if attempt + 1 < MAX_RETRIES:
+            await asyncio.sleep(2 ** attempt)  # Exponential backoff, outside of the semaphore to not hold a slot
+    logger.error(f'Can not access a page {url}, {error}')
+
+
+def get_row_cells(row) -> tuple[str, str, str, str]:  # link text, link url, title, year
+    tds = row.findall('td')
+    if len(tds) == len(ROW_CELLS_CLASSES) and all(
+            td.get('class') == cls for td, cls in zip(tds, ROW_CELLS_CLASSES)):  # Columns order is stable
+        link, title, year = tds[0].find('a'), tds[1], tds[2]
+    else:  # Unexpected table schema, look up by classes
+        link = row.xpath('.//a')[0]
+        title = row.xpath('./td[contains(@class, "MiddleCellSpacer")]')[0]
+        year = row.xpath('./td[contains(@class, "EndCellSpacer")]')[0]
+    return link.text_content(), link.get('href'), title.text_content(), year.text_content()
+
+
+def write_file(filename: str, data: bytes):
+    with open(file=f'{filename}.part', mode='wb', buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(data)
+    os_replace(f'{filename}.part', filename)  # Atomic, so interrupted write is not taken as a saved file
+
+
+def get_pdf_filename(form_number: str, current_year: int) -> str:
+    return f"{form_number}/{form_number}_{current_year}.pdf"
+
+
+async def download_pdf(url: str, form_number: str, current_year: int, client: httpx_AsyncClient,
+                       semaphore: asyncio.Semaphore, ):
+    try:
+        resp = await load_page(url=url, client=client, semaphore=semaphore)
+        if resp is None:
+            return
+        if form_number not in _created_dirs:
+            # See https://docs.python.org/3/library/pathlib.html#pathlib.Path.mkdir
+            pathlib_Path(form_number).mkdir(parents=True, exist_ok=True)  # exist_ok - skip FileExistsError
+            _created_dirs.add(form_number)
+        filename = get_pdf_filename(form_number=form_number, current_year=current_year)
+        await asyncio.to_thread(write_file, filename=filename, data=resp)  # Single thread dispatch per file
+    except Exception as e:
+        logger.error(f'Can not save file, error: {e}')
+
+
+# Runs in the process pool, logger of the worker may have no sinks (spawn), so errors are returned to parent
+def parse_page(page: bytes) -> tuple[int, bytes, list[tuple[str, int, str]], list[str]]:
+    page_forms: dict[str, dict] = {}  # form_number: form
+    page_pdfs = []  # form_number, current_year, url
+    page_errors = []
+    rows = get_page_rows(page=page)
+    for row in rows:  # Single pass for both forms json and pdf
         try:
-            form_number = row.findChild(['LeftCellSpacer', 'a']).string.split(' (', 1)[0]  # split to remove non eng ver
-            current_year = int(row.find(name='td', attrs={'class': 'EndCellSpacer'}).string.strip())
-            index = is_key_in_dict(dict_key=form_number, array=page_forms)
-            if index is None:
-                page_forms.append({
+            link_text, url, title, year = get_row_cells(row=row)
+            current_year = int(year.strip())
+            form_number = link_text.split(' (', 1)[0]  # split to remove non eng ver
+            page_form = page_forms.get(form_number)
+            if page_form is None:
+                page_forms[form_number] = {
                     'form_number': form_number,  # Title in reality
-                    'form_title': row.find(name='td', attrs={'class': 'MiddleCellSpacer'}).string.strip(),
+                    'form_title': title.strip(),
                     'min_year': current_year,
                     'max_year': current_year,
-                })
+                }
             else:  # If exists - modify form
-                if page_forms[index]['min_year'] > current_year:
-                    page_forms[index]['min_year'] = current_year
-                elif page_forms[index]['max_year'] < current_year:
-                    page_forms[index]['max_year'] = current_year
-        except Exception as e:
-            logger.error(f'Error: {e}')
-    return [json_dumps(page_form) for page_form in page_forms]  # What to do whit this data?
-
-
-async def save_page_form_pdf(rows, session):
-    for row in rows:
-        try:
-            current_year = int(row.find(name='td', attrs={'class': 'EndCellSpacer'}).string.strip())
-            form_number_elem = row.findChild(['LeftCellSpacer', 'a'])  # link and name
-            form_number = form_number_elem.string.split(' (', 1)[0]  # split to remove non eng ver
-            if MIN_YEAR <= current_year <= MAX_YEAR:
-                resp = await load_page(url=form_number_elem.attrs['href'], session=session)
-                # See https://docs.python.org/3/library/pathlib.html#pathlib.Path.mkdir
-                pathlib_Path(form_number).mkdir(parents=True, exist_ok=True)  # exist_ok - skip FileExistsError
-                filename = f"{form_number}/{form_number}_{current_year}.pdf"
-                async with aiofiles.open(file=filename, mode='wb') as f:
-                    await f.write(resp)
+                if page_form['min_year'] > current_year:
+                    page_form['min_year'] = current_year
+                if page_form['max_year'] < current_year:
+                    page_form['max_year'] = current_year
+            if not MIN_YEAR <= current_year <= MAX_YEAR:  # Only json is needed for the row
+                continue
+            page_pdfs.append((form_number, current_year, url))
         except Exception as e:
-            logger.error(f'Can not save file, error: {e}')
+            page_errors.append(f'Error: {e}')
+    return len(rows), orjson_dumps(list(page_forms.values())) if page_forms else b'', page_pdfs, page_errors
+
+
+async def save_page_forms_json(page_forms_json: bytes, index_of_first_row: int):
+    try:
+        filename = f'{FORMS_JSON_DIR}/{index_of_first_row}.json'
+        await asyncio.to_thread(write_file, filename=filename, data=page_forms_json)
+    except Exception as e:
+        logger.error(f'Can not save file, error: {e}')
+
+
+async def download_page_pdfs(page_pdfs: list[tuple[str, int, str]], client: httpx_AsyncClient,
+                             semaphore: asyncio.Semaphore, ):
+    tasks = []
+    for form_number, current_year, url in page_pdfs:
+        if (form_number, current_year) in _downloaded:  # Pages may overlap (sort ties), skip the same pdf
+            continue
+        _downloaded.add((form_number, current_year))  # No lock - nothing is awaited between the check and add
+        filename = get_pdf_filename(form_number=form_number, current_year=current_year)
+        if os_path_exists(filename) and os_path_getsize(filename) > 0:  # Saved by a previous run
+            continue
+        tasks.append(download_pdf(url=url,
+                                  form_number=form_number,
+                                  current_year=current_year,
+                                  client=client,
+                                  semaphore=semaphore, ))
+    await asyncio.gather(*tasks)  # Download all the pdf of the page
+
+
+async def load_and_parse_page(url: str, loop: asyncio.AbstractEventLoop, process_pool: ProcessPoolExecutor,
+                              client: httpx_AsyncClient, semaphore: asyncio.Semaphore, ):
+    page = await load_page(url=url, client=client, semaphore=semaphore)
+    if page is None:  # Not loaded, error is already logged
+        return None
+    try:
+        # Parse in other process, so the pending requests keep progressing while CPU is busy with html
+        rows_count, page_forms_json, page_pdfs, page_errors = await loop.run_in_executor(
+            process_pool, parse_page, page)
+    except Exception as e:
+        logger.error(f'Can not parse a page, error: {e}')
+        return None
+    for error in page_errors:
+        logger.error(error)
+    return rows_count, page_forms_json, page_pdfs
+
+
+def get_page_rows(page: bytes) -> list:
+    tree = lxml_html_fromstring(page)  # C parser and XPath, no python tree building
+    tables = tree.xpath('//table[contains(@class, "picklist-dataTable")]')  # Target
+    if not tables:
+        return []
+    return tables[0].xpath('.//tr')[1:]  # [1:] - Just wrong HTML
 
 
 async def main():
-    async with aiohttp_ClientSession() as session:
-        tasks = []
-        pagination = 0
-        while 1:
-            url = (f'https://apps.irs.gov/app/picklist/list/priorFormPublication.html?'
-                   f'indexOfFirstRow={pagination}&'
-                   f'sortColumn=sortOrder&'
-                   f'value=&criteria=&'
-                   f'resultsPerPage=200&'
-                   f'isDescending=false')
-            page = await load_page(url=url, session=session)
-            soup = BeautifulSoup(page, 'html.parser')
-            table = soup.find(name='table', attrs={'class': 'picklist-dataTable'})  # Target
-            rows = table.find_all(name='tr')[1:]  # [1:] - Just wrong HTML
-            if rows:
-                tasks.append(await parse_page_forms_json(rows=rows))  # Task 1
-                tasks.append(await save_page_form_pdf(rows=rows, session=session))  # Task 2
-                pagination += 200
-            else:  # Stop pagination
+    semaphore = asyncio.Semaphore(MAX_REQUESTS)
+    # Explicit limits - keep-alive connections are reused instead of a new handshake per pdf
+    # HTTP/2 - many pdf requests are multiplexed over a single connection
+    limits = httpx_Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60)
+    timeout = httpx_Timeout(None, connect=10, read=30)  # Slow pdf will not stall forever
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=os_cpu_count()) as process_pool:
+        async with httpx_AsyncClient(http2=True, limits=limits, timeout=timeout) as client:
+            tasks = []
+            pathlib_Path(FORMS_JSON_DIR).mkdir(parents=True, exist_ok=True)  # exist_ok - skip FileExistsError
+            pagination = 0
+            while 1:
+                # Pages count is unknown, so fetch the next batch of pages speculatively
+                first_rows = range(pagination, pagination + PAGES_IN_FLIGHT * PAGE_SIZE, PAGE_SIZE)
+                pages = []
+                for first_row in first_rows:
+                    url = httpx_URL(PAGE_BASE_URL, params={**PAGE_PARAMS, 'indexOfFirstRow': first_row})
+                    pages.append(asyncio.create_task(load_and_parse_page(url=url,
+                                                                         loop=loop,
+                                                                         process_pool=process_pool,
+                                                                         client=client,
+                                                                         semaphore=semaphore, )))
+                pagination = first_rows.stop
+                failed_pages = 0
+                for first_row, page in zip(first_rows, pages):
+                    parsed_page = await page
+                    if parsed_page is None:  # Skip the page, error is already logged
+                        failed_pages += 1
+                        continue
+                    rows_count, page_forms_json, page_pdfs = parsed_page
+                    if rows_count and not page_forms_json:  # Rows are not parsed (schema changed?), skip the page
+                        logger.error(f'Can not parse any of {rows_count} rows of the page {first_row}')
+                    elif rows_count:
+                        tasks.append(asyncio.create_task(save_page_forms_json(page_forms_json=page_forms_json,
+                                                                              index_of_first_row=first_row, )))
+                        if page_pdfs:  # Most of the pages have no pdf of the years range
+                            tasks.append(asyncio.create_task(download_page_pdfs(page_pdfs=page_pdfs,
+                                                                                client=client,
+                                                                                semaphore=semaphore, )))
+                    else:  # Stop pagination, last page (table without rows) is reached
+                        for speculative_page in pages:
+                            speculative_page.cancel()  # Done pages are not affected
+                        break
+                else:  # No empty page in the batch
+                    if failed_pages < len(pages):
+                        continue
+                    logger.error('Can not load any page of the batch, stop pagination')
                 break
-        await asyncio.gather(*tasks)
+            await asyncio.gather(*tasks)
 
 
 if __name__ == '__main__':
     # See https://github.com/encode/httpx/issues/914#issuecomment-622586610 (exit code is 0, but error is exists)
     if sys_platform.startswith('win'):
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    else:  # uvloop is not available on Windows
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     logger.add('errors.txt', level='ERROR', rotation="30 days", backtrace=True)
     asyncio.run(main())
 
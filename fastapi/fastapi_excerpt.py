@@ -1,30 +1,69 @@
+import asyncio
+import logging
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from os import cpu_count as os_cpu_count
 from httpx import AsyncClient
-from fastapi import APIRouter, Depends, Query, responses, Header
+from fastapi import APIRouter, BackgroundTasks, Depends, Query, responses, Header
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from app import send_email, schemas, config, crud, services
 from app.database import get_db
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from datetime import datetime, timedelta
+from time import time
 from secrets import token_urlsafe as secrets_token_urlsafe
+from orjson import loads as orjson_loads
 
 
-router = APIRouter()
+router = APIRouter(default_response_class=responses.ORJSONResponse)  # orjson is faster than default json
+CONFIRM_LINK_LIFETIME = 60 * 60 * 24 * 2  # Seconds
+HASH_POOL = ThreadPoolExecutor(max_workers=os_cpu_count())  # Password hashing is slow on purpose
+# Shared client - connections (and TLS sessions) to google are reused between the oauth callbacks
+GOOGLE_CLIENT: Optional[AsyncClient] = None  # Created on every startup, closed on shutdown
+
+
+logger = logging.getLogger(__name__)
+
+
+def send_confirm_link(token: str, endpoint: str, email: str):  # Background task, error has no response to go to
+    try:
+        send_email.confirm_link(token=token, endpoint=endpoint, email=email)
+    except Exception as error:
+        logger.error(f'Can not send confirmation link to {email}, error: {error}')
+
+
+@router.on_event("startup")
+async def open_google_client():
+    global GOOGLE_CLIENT
+    GOOGLE_CLIENT = AsyncClient(http2=True, base_url='https://oauth2.googleapis.com', timeout=10)
+
+
+@router.on_event("shutdown")
+async def close_google_client():
+    await GOOGLE_CLIENT.aclose()
 
 
 @router.post("/register", status_code=201)
-def register(
-        user_create: schemas.UserCreate,    
+async def register(
+        user_create: schemas.UserCreate,
+        background_tasks: BackgroundTasks,
         db: Session = Depends(get_db)):
     try:
-        if not crud.read_user_by(db, column='email', value=user_create.email):
+        # Session is synchronous, so the queries are run in the threadpool, not on the event loop
+        if not await run_in_threadpool(crud.read_user_by, db, column='email', value=user_create.email):
             registration_token = secrets_token_urlsafe(nbytes=config.URL_TOKEN_SIZE)  # Create url-safe secret token
-            send_email.confirm_link(token=registration_token,
-                                    endpoint='http://127.0.0.1:8000/confirm-email',
-                                    email=user_create.email)
-            return crud.create_user(db=db, user = {'access_token': registration_token,
-                                                   'login': user_create.login,
-                                                   'hashed_password': config.pwd_context.hash(user_create.password)}, )
+            # Hash in the pool, so the event loop is not blocked
+            hashed_password = await asyncio.get_running_loop().run_in_executor(
+                HASH_POOL, config.pwd_context.hash, user_create.password)
+            background_tasks.add_task(send_confirm_link,  # Send after the response
+                                      token=registration_token,
+                                      endpoint='http://127.0.0.1:8000/confirm-email',
+                                      email=user_create.email)
+            user = {'access_token': registration_token,
+                    'login': user_create.login,
+                    'hashed_password': hashed_password,
+                    'expires_at': int(time()) + CONFIRM_LINK_LIFETIME}
+            return await run_in_threadpool(crud.create_user, db=db, user=user, )
         else:
             raise config.fastapi_http_errors['email_already_exists_409']
     except Exception as error:
@@ -40,7 +79,10 @@ def confirm_email(token: str = Query(...,
                   db: Session = Depends(get_db), ):
     try:
         user = crud.read_user_by(db=db, column='current_token', value=token)
-        if user.created_datetime + timedelta(minutes=60 * 24 * 2) > datetime.now():
+        expires_at = user.expires_at  # Unix timestamp, set on registration
+        if expires_at is None:  # User is registered before the column was added
+            expires_at = int(user.created_datetime.timestamp()) + CONFIRM_LINK_LIFETIME
+        if int(time()) < expires_at:
             jwt_token = services.create_access_token(email=user.email)  # Create jwt token instead of url_safe token
             crud.update_user(db=db, user=user, new_user={'is-active': True, 'current_token': jwt_token})
             return responses.RedirectResponse(url='')  # TODO add endpoint to redirect
@@ -91,12 +133,10 @@ def user_restore_password(
                            example='nuLouGT8Tl6adEtiHBlaDg2bKQ3G5Q6pD7rrqfL71vz4W3ieoSZn_r8jqSMWgJN8'),
         db: Session = Depends(get_db)):
     try:
-        if user := crud.read_user_by(db, column='reset_token', value=token):
-            crud.update_user(db=db, user=user, new_user=schemas.UserUpdate(
-                {'reset_token': secrets_token_urlsafe(config.URL_TOKEN_SIZE)}))
-            # TODO create new pass
-        else:
+        if not crud.update_user_by(db=db, column='reset_token', value=token, new_user={
+                'reset_token': secrets_token_urlsafe(config.URL_TOKEN_SIZE)}):  # Single UPDATE ... RETURNING
             raise config.fastapi_http_errors['wrong_token_403']
+        # TODO create new pass
     except Exception as error:
         services.error_handler(error)
 
@@ -117,7 +157,7 @@ def refresh_token(
 @router.post("/logout")
 def logout(token: str = Header(...), db: Session = Depends(get_db)):
     try:
-        if user := services.get_user_by_token(db=db, token=token):
+        if user := services.get_user_by_token(db=db, token=token):  # Validates the token, not just matches it
             crud.update_user(db=db, user=user, new_user={'current_token': None})
             return f'Successfully logout user_id {user.id}'
     except Exception as error:
@@ -142,23 +182,23 @@ async def google_oauth(
                                     description="Code that google sends as response (to redirect_uri) for the request. "
                                                 "App must exchange this code on the access token (of user info?)")):
     try:
-        async with AsyncClient() as async_client:  # See https://www.python-httpx.org/async/#making-requests
-            response = await async_client.post("https://oauth2.googleapis.com/token",  # Make asynchronous post request
-                                               data={"code": code,  # AA code from url
-                                                     "client_id": config.google_oauth_client_id,
-                                                     "client_secret": config.google_oauth_secret,
-                                                     "redirect_uri": config.google_oauth_redirect_uri,
-                                                     "grant_type": "authorization_code", })  # default
-            response = response.json()  # -Convert string response to python dict (initial request is coroutine)
-            user_email = services.decode_jwt_rsa(token=response['id_token'], access_token=response['access_token'])
-            access_token = services.create_access_token(email=user_email)  # access_token in the token isn't encrypted!
-            if user := crud.read_user_by(db=db, column='email', value=user_email):
-                crud.update_user(db=db, user=user, new_user={'current_token': access_token})
-            else:
-                crud.create_user(db=db, user={'email': user_email,
-                                       'hashed_password': access_token,  # User may login via password (token) also
-                                       'is_active': True,}, )
-            return user
+        # See https://www.python-httpx.org/async/#making-requests
+        response = await GOOGLE_CLIENT.post("/token",  # Make asynchronous post request
+                                            data={"code": code,  # AA code from url
+                                                  "client_id": config.google_oauth_client_id,
+                                                  "client_secret": config.google_oauth_secret,
+                                                  "redirect_uri": config.google_oauth_redirect_uri,
+                                                  "grant_type": "authorization_code", })  # default
+        response = orjson_loads(response.content)  # -Convert bytes response to python dict (httpx uses std json)
+        user_email = services.decode_jwt_rsa(token=response['id_token'], access_token=response['access_token'])
+        access_token = services.create_access_token(email=user_email)  # access_token in the token isn't encrypted!
+        user = crud.update_user_by(db=db, column='email', value=user_email,
+                                   new_user={'current_token': access_token})  # Single UPDATE ... RETURNING
+        if user is None:
+            crud.create_user(db=db, user={'email': user_email,
+                                   'hashed_password': access_token,  # User may login via password (token) also
+                                   'is_active': True,}, )
+        return user
     except Exception as e:
         services.error_handler(error=e)
 